@@ -11,7 +11,10 @@ Since: 2023-07
 from fairpyx import divide, AgentBundleValueMatrix, Instance
 import fairpyx.algorithms as crs
 from typing import *
+from functools import lru_cache
+import itertools
 import numpy as np
+import experiments_csv
 
 max_value = 1000
 normalized_sum_of_values = 1000
@@ -46,17 +49,34 @@ def evaluate_algorithm_on_instance(algorithm, instance):
 
 
 
+def warm_instance_cache(random_instance:Callable, input_ranges:dict):
+    """
+    Generate in advance the instances of all runs, so that the timed runs only look them up,
+    and the instance generation is not charged to the first algorithm that runs on each instance.
+
+    The instances are generated with keyword arguments, in the order of input_ranges.
+    lru_cache keys keyword and positional calls (and different keyword orders) differently,
+    so the timed runs must call random_instance with keyword arguments in the same order.
+
+    NOTE: this ignores the resume and time-limit skipping of experiments_csv,
+    so it also generates the instances of runs that are already in the results file, or that will be skipped.
+    """
+    instance_ranges = {name: values for name, values in input_ranges.items() if name != "algorithm"}
+    for values in itertools.product(*instance_ranges.values()):
+        random_instance(**dict(zip(instance_ranges.keys(), values)))
+
+
+
 ######### EXPERIMENT WITH UNIFORMLY-RANDOM DATA ##########
 
-def course_allocation_with_random_instance_uniform(
-    num_of_agents:int, num_of_items:int, 
-    value_noise_ratio:float,
-    algorithm:Callable,
-    random_seed: int,):
+# The instance depends only on the parameters and the seed, not on the algorithm,
+# so it is generated once and shared by all algorithms that run on it.
+@lru_cache(maxsize=None)
+def random_instance_uniform(num_of_agents:int, num_of_items:int, value_noise_ratio:float, random_seed:int):
     agent_capacity_bounds =  [6,6]
     item_capacity_bounds = [40,40]    
     np.random.seed(random_seed)
-    instance = Instance.random_uniform(
+    return Instance.random_uniform(
         num_of_agents=num_of_agents, num_of_items=num_of_items, 
         normalized_sum_of_values=normalized_sum_of_values,
         agent_capacity_bounds=agent_capacity_bounds, 
@@ -64,6 +84,14 @@ def course_allocation_with_random_instance_uniform(
         item_base_value_bounds=[1,max_value],
         item_subjective_ratio_bounds=[1-value_noise_ratio, 1+value_noise_ratio]
         )
+
+def course_allocation_with_random_instance_uniform(
+    num_of_agents:int, num_of_items:int, 
+    value_noise_ratio:float,
+    algorithm:Callable,
+    random_seed: int,):
+    instance = random_instance_uniform(
+        num_of_agents=num_of_agents, num_of_items=num_of_items, value_noise_ratio=value_noise_ratio, random_seed=random_seed)
     return evaluate_algorithm_on_instance(algorithm, instance)
 
 def run_uniform_experiment():
@@ -76,13 +104,15 @@ def run_uniform_experiment():
         "algorithm": algorithms_to_check,
         "random_seed": range(5),
     }
+    warm_instance_cache(random_instance_uniform, input_ranges)
     experiment.run_with_time_limit(course_allocation_with_random_instance_uniform, input_ranges, time_limit=TIME_LIMIT)
 
 
 
 ######### EXPERIMENT WITH DATA GENERATED ACCORDING TO THE SZWS MODEL ##########
 
-def course_allocation_with_random_instance_szws(
+@lru_cache(maxsize=None)
+def random_instance_szws(
     num_of_agents:int, num_of_items:int, 
     agent_capacity:int,
     supply_ratio:float,
@@ -90,10 +120,9 @@ def course_allocation_with_random_instance_szws(
     mean_num_of_favorite_items:float,
     favorite_item_value_bounds:tuple[int,int],
     nonfavorite_item_value_bounds:tuple[int,int],
-    algorithm:Callable,
     random_seed: int,):
     np.random.seed(random_seed)
-    instance = Instance.random_szws(
+    return Instance.random_szws(
         num_of_agents=num_of_agents, num_of_items=num_of_items, normalized_sum_of_values=normalized_sum_of_values,
         agent_capacity=agent_capacity, 
         supply_ratio=supply_ratio, 
@@ -102,6 +131,26 @@ def course_allocation_with_random_instance_szws(
         favorite_item_value_bounds=favorite_item_value_bounds,
         nonfavorite_item_value_bounds=nonfavorite_item_value_bounds,
         )
+
+def course_allocation_with_random_instance_szws(
+    num_of_agents:int, num_of_items:int, 
+    agent_capacity:int,
+    supply_ratio:float,
+    num_of_popular_items:int,
+    mean_num_of_favorite_items:float,
+    favorite_item_value_bounds:tuple[int,int],
+    nonfavorite_item_value_bounds:tuple[int,int],
+    algorithm:Callable,
+    random_seed: int,):
+    instance = random_instance_szws(
+        num_of_agents=num_of_agents, num_of_items=num_of_items, 
+        agent_capacity=agent_capacity,
+        supply_ratio=supply_ratio,
+        num_of_popular_items=num_of_popular_items,
+        mean_num_of_favorite_items=mean_num_of_favorite_items,
+        favorite_item_value_bounds=favorite_item_value_bounds,
+        nonfavorite_item_value_bounds=nonfavorite_item_value_bounds,
+        random_seed=random_seed)
     return evaluate_algorithm_on_instance(algorithm, instance)
 
 def run_szws_experiment():
@@ -119,6 +168,7 @@ def run_szws_experiment():
         "algorithm": algorithms_to_check,
         "random_seed": range(5),
     }
+    warm_instance_cache(random_instance_szws, input_ranges)
     experiment.run_with_time_limit(course_allocation_with_random_instance_szws, input_ranges, time_limit=TIME_LIMIT)
 
 
@@ -130,15 +180,12 @@ filename = "data/ariel_5783_input.json"
 with open(filename, "r", encoding="utf-8") as file:
     ariel_5783_input = json.load(file)
 
-def course_allocation_with_random_instance_sample(
-    max_total_agent_capacity:int, 
-    algorithm:Callable,
-    random_seed: int,):
+@lru_cache(maxsize=None)
+def random_instance_sample(max_total_agent_capacity:int, random_seed:int):
     np.random.seed(random_seed)
-
     (valuations, agent_capacities, item_capacities, agent_conflicts, item_conflicts) = \
         (ariel_5783_input["valuations"], ariel_5783_input["agent_capacities"], ariel_5783_input["item_capacities"], ariel_5783_input["agent_conflicts"], ariel_5783_input["item_conflicts"])
-    instance = Instance.random_sample(
+    return Instance.random_sample(
         max_num_of_agents = max_total_agent_capacity, 
         max_total_agent_capacity = max_total_agent_capacity,
         prototype_agent_conflicts=agent_conflicts,
@@ -146,6 +193,12 @@ def course_allocation_with_random_instance_sample(
         prototype_valuations=valuations,
         item_capacities=item_capacities,
         item_conflicts=item_conflicts)
+
+def course_allocation_with_random_instance_sample(
+    max_total_agent_capacity:int, 
+    algorithm:Callable,
+    random_seed: int,):
+    instance = random_instance_sample(max_total_agent_capacity=max_total_agent_capacity, random_seed=random_seed)
     return evaluate_algorithm_on_instance(algorithm, instance)
 
 def run_ariel_experiment():
@@ -156,6 +209,7 @@ def run_ariel_experiment():
         "algorithm": algorithms_to_check,
         "random_seed": range(10),
     }
+    warm_instance_cache(random_instance_sample, input_ranges)
     experiment.run_with_time_limit(course_allocation_with_random_instance_sample, input_ranges, time_limit=TIME_LIMIT)
 
 
@@ -163,10 +217,20 @@ def run_ariel_experiment():
 ######### MAIN PROGRAM ##########
 
 if __name__ == "__main__":
-    import logging, experiments_csv
+    import logging, os, sys
+    from concurrent.futures import ProcessPoolExecutor
     experiments_csv.logger.setLevel(logging.INFO)
-    run_uniform_experiment()
-    run_szws_experiment()
-    run_ariel_experiment()
+    experiments = [run_uniform_experiment, run_szws_experiment, run_ariel_experiment]
+    if "--parallel" in sys.argv:
+        # The experiments are independent and write to different CSV files, so each of them can run in its own process.
+        # NOTE: the processes compete for the CPU, so the recorded runtimes (and hence the runs skipped by the time limit)
+        #       are not comparable to those of a sequential run.
+        with ProcessPoolExecutor(max_workers=min(len(experiments), os.cpu_count() or 1)) as executor:
+            futures = [executor.submit(experiment) for experiment in experiments]
+            for future in futures:
+                future.result()   # re-raise any exception from the worker
+    else:
+        for experiment in experiments:
+            experiment()
 
 
@@ -19,7 +19,8 @@ def sort_and_tie_brake(input_dict: Dict[str, float], tie_braking_lottery: Dict[s
     """
     Sorts a dictionary by its values in descending order and adds a number
     to the values of keys with the same value to break ties.
-    Stops if the count surpasses the course's capacity and is not in a tie.
+    Stops if the count surpasses the course's capacity and is not in a tie,
+    provided that no later bid can overtake an earlier one by its tie-breaking addition.
 
     Parameters:
     input_dict (Dict[str, float]): A dictionary with string keys and float values representing student bids.
@@ -28,6 +29,14 @@ def sort_and_tie_brake(input_dict: Dict[str, float], tie_braking_lottery: Dict[s
 
     Returns:
     List[tuple[str, float]]: A list of tuples containing student names and their modified bids, sorted in descending order.
+
+    Example (the tie between "c" and "d" is beyond the course capacity, so it is left unbroken):
+    >>> sort_and_tie_brake({"a": 5, "b": 5, "c": 3, "d": 3}, {"a": 0.1, "b": 0.2, "c": 0.3, "d": 0.4}, course_capacity=1)
+    [('b', 5.2), ('a', 5.1), ('c', 3), ('d', 3)]
+
+    Example (after tie-breaking, "b" overtakes "a", so the search goes on beyond the course capacity):
+    >>> sort_and_tie_brake({"a": 5, "b": 4.5, "c": 4.5}, {"a": 0.1, "b": 0.9, "c": 0.2}, course_capacity=1)
+    [('b', 5.4), ('a', 5), ('c', 4.7)]
     """
     # Sort the dictionary by values in descending order
     sorted_dict = dict(sorted(input_dict.items(), key=lambda item: item[1], reverse=True))
@@ -38,6 +47,9 @@ def sort_and_tie_brake(input_dict: Dict[str, float], tie_braking_lottery: Dict[s
     
     # Initialize a variable to track count
     count: int = 0
+
+    # Tie-breaking raises a bid by at most this much, so a bid can overtake an earlier one only if they are closer than that:
+    max_lottery_value = max(tie_braking_lottery.values(), default=0)
     
     # Iterate over the sorted dictionary and modify values
     for key in sorted_dict:
@@ -47,12 +59,13 @@ def sort_and_tie_brake(input_dict: Dict[str, float], tie_braking_lottery: Dict[s
             # If current value is the same as previous, add the number to both current and previous values
             sorted_dict[key] += tie_braking_lottery[key]
             sorted_dict[prev_key] += tie_braking_lottery[prev_key]
-        elif count >= course_capacity:
+        elif count >= course_capacity and (previous_value is None or input_dict[prev_key] - current_value >= max_lottery_value):
             break
             
         # Update previous_value and prev_key to current_value and key for next iteration
         previous_value = sorted_dict[key]
         prev_key = key
+        count += 1
     
     # Sort again after tie-breaking
     sorted_dict = (sorted(sorted_dict.items(), key=lambda item: item[1], reverse=True))
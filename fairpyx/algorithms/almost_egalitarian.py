@@ -10,8 +10,7 @@ from fairpyx import Instance, AllocationBuilder, ExplanationLogger
 from fairpyx.algorithms.iterated_maximum_matching import iterated_maximum_matching
 from fairpyx.algorithms.fractional_egalitarian import fractional_egalitarian_utilitarian_allocation
 
-import cvxpy, numpy as np, networkz as nx
-from fairpyx.utils.solve import solve
+import numpy as np, networkz as nx
 from collections import defaultdict
 # import matplotlib.pyplot as plt # for plotting the consumption graph (for debugging)
 
@@ -6,17 +6,69 @@ Programmer: Erel Segal-Halevi.
 Since: 2023-07
 """
 
-import cvxpy
+import numpy as np, scipy.optimize, scipy.sparse
 
 from fairpyx import Instance
-from fairpyx.utils.linear_programming_utils import allocation_variables, allocation_constraints
-from fairpyx.utils.solve import solve
+from fairpyx.utils.linear_programming_utils import allocation_values, allocation_matrix_constraints
 
 
 
 import logging
 logger = logging.getLogger(__name__)
 
+UTILITARIAN_TOLERANCE = 1e-9   # relative tolerance for deciding that an allocation attains the utilitarian upper bound
+
+
+def _solve_linear_program(c:np.ndarray, A_ub, b_ub:np.ndarray, bounds:np.ndarray, solver_options:dict)->np.ndarray:
+    """
+    Minimize c @ x subject to A_ub @ x <= b_ub and the given bounds, using HiGHS directly (without building a cvxpy expression tree).
+
+    :return the optimal x.
+    """
+    result = scipy.optimize.linprog(c, A_ub=A_ub, b_ub=b_ub, bounds=bounds, method="highs-ds", options=solver_options)  # highs-ds is a variant of simplex (guaranteed to return a corner solution)
+    if result.status == 2:
+        raise ValueError("Problem is infeasible")
+    elif result.status == 3:
+        raise ValueError("Problem is unbounded")
+    elif result.status != 0:
+        raise RuntimeError(f"Solver failed: {result.message}")
+    return result.x
+
+
+def _egalitarian_value(values:np.ndarray, A_ub, b_ub:np.ndarray, bounds:np.ndarray, utility_rows, solver_options:dict)->tuple:
+    """
+    Find an allocation that maximizes the minimum utility.
+    The variables are the flattened allocation matrix, plus one more variable for the minimum utility.
+
+    :return (the flattened allocation, the minimum utility).
+    """
+    num_of_agents = values.shape[0]
+    c = np.zeros(A_ub.shape[1]+1)
+    c[-1] = -1   # maximize the minimum utility
+    A_ub = scipy.sparse.vstack([
+        scipy.sparse.hstack([A_ub, scipy.sparse.csr_matrix((A_ub.shape[0],1))]),
+        scipy.sparse.hstack([-utility_rows, np.ones((num_of_agents,1))]),     # min_utility <= utility of each agent
+    ], format="csr")
+    b_ub = np.concatenate([b_ub, np.zeros(num_of_agents)])
+    bounds = np.vstack([bounds, [-np.inf, np.inf]])
+    solution = _solve_linear_program(c, A_ub, b_ub, bounds, solver_options)
+    return solution[:-1], solution[-1]
+
+
+def _utilitarian_upper_bound(instance: Instance, values:np.ndarray, bounds:np.ndarray)->float:
+    """
+    An upper bound on the sum of utilities: each agent gets its best bundle of allowed items, ignoring item capacities and item conflicts.
+    """
+    allowed_values = np.clip(values, 0, None) * bounds[:,1].reshape(values.shape)
+    sorted_values = -np.sort(-allowed_values, axis=1)
+    agent_capacities = np.array([instance.agent_capacity(agent) for agent in instance.agents])
+    return np.sum(sorted_values, where=np.arange(values.shape[1]) < agent_capacities[:,np.newaxis])
+
+
+def _allocation_matrix(instance: Instance, allocation:np.ndarray)->dict:
+    allocation = allocation.reshape(instance.num_of_agents, instance.num_of_items)
+    return {agent: {item: allocation[i,j]+0 for j,item in enumerate(instance.items)} for i,agent in enumerate(instance.agents)}
+
 
 def fractional_egalitarian_allocation(instance: Instance, normalize_utilities=True, **solver_options):
     """
@@ -24,11 +76,11 @@ def fractional_egalitarian_allocation(instance: Instance, normalize_utilities=Tr
 
     :param instance: a fair-course-allocation instance.
     :param normalize_utilities: True to use utilities normalized by the max possible agent value; False to use raw utilities.
-    :param solver_options: kwargs sent to the cvxpy solver.
+    :param solver_options: options sent to the HiGHS solver (see scipy.optimize.linprog).
 
     :param instance: a matrix v in which each row represents an agent, each column represents an object, and v[i][j] is the value of agent i to object j.
     :param allocation_constraint_function: a predicate w: R -> {true,false} representing an additional constraint on the allocation variables.
-    :param solver_options: kwargs sent to the cvxpy solver.
+    :param solver_options: options sent to the HiGHS solver (see scipy.optimize.linprog).
 
     :return a fractional allocation --- a dict of dicts, in which alloc[i][j] is the fraction allocated to agent i from object j.
     
@@ -39,24 +91,31 @@ def fractional_egalitarian_allocation(instance: Instance, normalize_utilities=Tr
     >>> a = fractional_egalitarian_allocation(instance, normalize_utilities=False)
     >>> rounded_allocation(a,3)
     {0: {0: 0.75, 1: 0.0}, 1: {0: 0.25, 1: 1.0}}
+
+    ### item conflicts:
+    >>> instance = Instance(valuations=[[4,3,1]], item_conflicts={0: [1], 1: [0]})
+    >>> a = fractional_egalitarian_allocation(instance, normalize_utilities=False)
+    >>> rounded_allocation(a,3)
+    {0: {0: 1.0, 1: 0.0, 2: 1.0}}
+
+    ### agent conflicts:
+    >>> instance = Instance(valuations=[[4,3,1]], agent_conflicts={0: [0]})
+    >>> a = fractional_egalitarian_allocation(instance, normalize_utilities=False)
+    >>> rounded_allocation(a,3)
+    {0: {0: 0.0, 1: 1.0, 2: 1.0}}
     """
 
-    allocation_vars, raw_utilities, normalized_utilities = allocation_variables(instance)
-    utilities = normalized_utilities if normalize_utilities else raw_utilities
-    basic_constraints = allocation_constraints(instance, allocation_vars)
+    raw_values, normalized_values = allocation_values(instance)
+    values = normalized_values if normalize_utilities else raw_values
+    A_ub, b_ub, bounds = allocation_matrix_constraints(instance)
+    utility_rows = scipy.sparse.block_diag(list(values[:,np.newaxis,:]), format="csr")  # row i maps the flattened allocation to the utility of agent i
 
     # 1. Find the egalitarian value:
-    min_utility = cvxpy.Variable()
-    problem = cvxpy.Problem(
-        cvxpy.Maximize(min_utility),
-        constraints=basic_constraints + [min_utility <= utilities[agent] for agent in instance.agents],
-        **solver_options
-    )
-    solve(problem, solvers = [(cvxpy.SCIPY, {'method':'highs-ds'})])  # highs-ds is a variant of simplex (guaranteed to return a corner solution)
-
-    allocation_matrix = {agent: {item: allocation_vars[agent][item].value+0 for item in instance.items} for agent in instance.agents}
+    allocation, min_utility_value = _egalitarian_value(values, A_ub, b_ub, bounds, utility_rows, solver_options)
+
+    allocation_matrix = _allocation_matrix(instance, allocation)
     logger.debug("\nAllocation_matrix:\n%s", allocation_matrix)
-    logger.debug("\nUtilities:\n%s", {agent: utilities[agent].value+0 for agent in instance.agents})
+    logger.debug("\nUtilities:\n%s", dict(zip(instance.agents, utility_rows @ allocation + 0)))
     # logger.debug("\nRaw utilities:\n%s", {agent: raw_utilities[agent].value+0 for agent in instance.agents})
     # logger.debug("\nMax utilities:\n%s", {agent: instance.agent_maximum_value(agent) for agent in instance.agents})
     # logger.debug("\nNormalized utilities:\n%s", {agent: normalized_utilities[agent].value+0 for agent in instance.agents})
@@ -69,11 +128,11 @@ def fractional_egalitarian_utilitarian_allocation(instance: Instance, normalize_
 
     :param instance: a fair-course-allocation instance.
     :param normalize_utilities: True to use utilities normalized by the max possible agent value; False to use raw utilities.
-    :param solver_options: kwargs sent to the cvxpy solver.
+    :param solver_options: options sent to the HiGHS solver (see scipy.optimize.linprog).
 
     :param instance: a matrix v in which each row represents an agent, each column represents an object, and v[i][j] is the value of agent i to object j.
     :param allocation_constraint_function: a predicate w: R -> {true,false} representing an additional constraint on the allocation variables.
-    :param solver_options: kwargs sent to the cvxpy solver.
+    :param solver_options: options sent to the HiGHS solver (see scipy.optimize.linprog).
 
     :return a fractional allocation --- a dict of dicts, in which alloc[i][j] is the fraction allocated to agent i from object j.
 
@@ -114,37 +173,41 @@ def fractional_egalitarian_utilitarian_allocation(instance: Instance, normalize_
     >>> a = fractional_egalitarian_utilitarian_allocation(instance, normalize_utilities=False, tolerance_factor=0)
     >>> rounded_allocation(a,3)
     {0: {0: 1.0, 1: 0.0, 2: 1.0, 3: 1.0}, 1: {0: 0.0, 1: 1.0, 2: 0.0, 3: 0.0}}
+
+    ### no contention - the egalitarian allocation is also utilitarian-optimal:
+    >>> instance = Instance(valuations=[[5,1,0],[0,1,5]], agent_capacities=2, item_capacities=[1,2,1])
+    >>> a = fractional_egalitarian_utilitarian_allocation(instance, normalize_utilities=False)
+    >>> rounded_allocation(a,3)
+    {0: {0: 1.0, 1: 1.0, 2: 0.0}, 1: {0: 0.0, 1: 1.0, 2: 1.0}}
     """
 
-    allocation_vars, raw_utilities, normalized_utilities = allocation_variables(instance)
-    utilities = normalized_utilities if normalize_utilities else raw_utilities
-    basic_constraints = allocation_constraints(instance, allocation_vars)
+    raw_values, normalized_values = allocation_values(instance)
+    values = normalized_values if normalize_utilities else raw_values
+    A_ub, b_ub, bounds = allocation_matrix_constraints(instance)
+    utility_rows = scipy.sparse.block_diag(list(values[:,np.newaxis,:]), format="csr")  # row i maps the flattened allocation to the utility of agent i
 
     # 1. Find the egalitarian value:
-    min_utility = cvxpy.Variable()
-    problem = cvxpy.Problem(
-        cvxpy.Maximize(min_utility),
-        constraints=basic_constraints + [min_utility <= utilities[agent] for agent in instance.agents],
-        **solver_options
-    )
-    solve(problem, solvers = [(cvxpy.SCIPY, {'method':'highs-ds'})])  # highs-ds is a variant of simplex (guaranteed to return a corner solution)
+    allocation, min_utility_value = _egalitarian_value(values, A_ub, b_ub, bounds, utility_rows, solver_options)
 
     # 2. Find the utilitarian-subject-to-egalitarian value:
-    min_utility_value = min_utility.value
     logger.debug("\nEgalitarian utility:\n%s", min_utility_value)
     threshold_utility = (1-tolerance_factor)*min_utility_value
     logger.debug("\nThreshold for utilitarian allocation:\n%s", threshold_utility)
 
-    problem = cvxpy.Problem(
-        cvxpy.Maximize(sum(utilities.values())),
-        constraints=basic_constraints + [utilities[agent] >= threshold_utility for agent in instance.agents],
-        **solver_options
-    )
-    solve(problem, solvers = [(cvxpy.SCIPY, {'method':'highs-ds'})])
-
-    allocation_matrix = {agent: {item: allocation_vars[agent][item].value+0 for item in instance.items} for agent in instance.agents}
+    # The egalitarian allocation satisfies the threshold, so if it already attains the utilitarian upper bound, it is optimal for step 2 too:
+    upper_bound = _utilitarian_upper_bound(instance, values, bounds)
+    if values.ravel() @ allocation >= upper_bound - UTILITARIAN_TOLERANCE*max(1, upper_bound):
+        logger.debug("\nThe egalitarian allocation attains the utilitarian upper bound %s - skipping step 2", upper_bound)
+    else:
+        allocation = _solve_linear_program(
+            -values.ravel(),     # maximize the sum of utilities
+            scipy.sparse.vstack([A_ub, -utility_rows], format="csr"),                   # utility of each agent >= threshold_utility
+            np.concatenate([b_ub, np.full(instance.num_of_agents, -threshold_utility)]),
+            bounds, solver_options)
+
+    allocation_matrix = _allocation_matrix(instance, allocation)
     logger.debug("\nAllocation_matrix:\n%s", allocation_matrix)
-    logger.debug("\nUtilities:\n%s", {agent: utilities[agent].value+0 for agent in instance.agents})
+    logger.debug("\nUtilities:\n%s", dict(zip(instance.agents, utility_rows @ allocation + 0)))
     # logger.debug("\nRaw utilities:\n%s", {agent: raw_utilities[agent].value+0 for agent in instance.agents})
     # logger.debug("\nMax utilities:\n%s", {agent: instance.agent_maximum_value(agent) for agent in instance.agents})
     # logger.debug("\nNormalized utilities:\n%s", {agent: normalized_utilities[agent].value+0 for agent in instance.agents})
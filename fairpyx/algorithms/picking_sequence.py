@@ -29,17 +29,18 @@ def picking_sequence(alloc: AllocationBuilder, agent_order:list):
     {'Alice': ['c1', 'c3'], 'Bob': ['c1', 'c2', 'c3'], 'Chana': ['c2', 'c3'], 'Dana': ['c2', 'c3']}
     """
     logger.info("\nPicking-sequence with items %s , agents %s, and agent-order %s", alloc.remaining_item_capacities, alloc.remaining_agent_capacities, agent_order)
+    agent_item_value = alloc.instance.agent_item_value
     for agent in cycle(agent_order):
         if alloc.isdone():
             break 
         if not agent in alloc.remaining_agent_capacities:
             continue
-        potential_items_for_agent = set(alloc.remaining_items_for_agent(agent))
+        potential_items_for_agent = alloc.remaining_items_for_agent(agent)   # already excludes the items in conflict with the agent
         if len(potential_items_for_agent)==0:
             logger.info("Agent %s cannot pick any more items: remaining=%s, bundle=%s", agent, alloc.remaining_item_capacities, alloc.bundles[agent])
             alloc.remove_agent_from_loop(agent)
             continue
-        best_item_for_agent = max(potential_items_for_agent, key=lambda item: alloc.effective_value(agent,item))
+        best_item_for_agent = max(potential_items_for_agent, key=lambda item: agent_item_value(agent,item))
         alloc.give(agent, best_item_for_agent, logger)
 
 
@@ -7,7 +7,6 @@ Since: 2023-07
 
 from numbers import Number
 import numpy as np
-from functools import cache
 
 import logging
 logger = logging.getLogger(__name__)
@@ -132,6 +131,8 @@ class Instance:
         self.agent_conflicts = get_conflicts(agent_conflicts) or constant_function(set())
         self.item_conflicts = get_conflicts(item_conflicts) or constant_function(set())
 
+        self._agent_maximum_values = {}   # cache for agent_maximum_value
+
         # Keep the input parameters, for debug
         self._agent_capacities = agent_capacities
         self._item_capacities  = item_capacities
@@ -157,7 +158,8 @@ class Instance:
         :prioritized_items: a list of items that are "prioritized". 
              This list is used for tie-breaking, in cases the agent assigns the same value to different items.
         """
-        other_items = [item for item in self.items if item not in prioritized_items]
+        prioritized_items_set = set(prioritized_items)
+        other_items = [item for item in self.items if item not in prioritized_items_set]
         valuation = lambda item: self.agent_item_value(agent,item)
         sorted_items = sorted(prioritized_items + other_items, key=valuation, reverse=True)
         result = {}
@@ -185,13 +187,14 @@ class Instance:
  * item conflicts:  { {item: self.item_conflicts(item) for item in self.items} }
  """
     
-    @cache
     def agent_maximum_value(self, agent:any):
         """
         Return the maximum possible value of an agent: the sum of the top x items, where x is the agent's capacity.
+        The result is cached in the instance (a method-level cache would keep every instance alive forever).
         """
-        maxvalue = sum(sorted([self.agent_item_value(agent,item) for item in self.items],reverse=True)[0:self.agent_capacity(agent)])
-        return maxvalue
+        if agent not in self._agent_maximum_values:
+            self._agent_maximum_values[agent] = sum(sorted([self.agent_item_value(agent,item) for item in self.items],reverse=True)[0:self.agent_capacity(agent)])
+        return self._agent_maximum_values[agent]
 
 
     def agent_normalized_item_value(self, agent:any, item:any):
@@ -222,20 +225,19 @@ class Instance:
         """
         if random_seed is None:
             random_seed = np.random.randint(1, 2**31)
-        np.random.seed(random_seed)
+        rng = np.random.RandomState(random_seed)   # a private generator, so that the instance depends only on the seed, and the global random state is left alone
         logger.info("Random seed: %d", random_seed)
         agents  = [agent_name_template.format(index=i+1) for i in range(num_of_agents)]
         items   = [item_name_template.format(index=i+1) for i in range(num_of_items)]
-        agent_capacities  = {agent: np.random.randint(agent_capacity_bounds[0], agent_capacity_bounds[1]+1) for agent in agents}
-        item_capacities   = {item: np.random.randint(item_capacity_bounds[0], item_capacity_bounds[1]+1) for item in items}
-        base_values = normalized_valuation(random_valuation(num_of_items, item_base_value_bounds), normalized_sum_of_values)
-        valuations = {
-            agent: dict(zip(items, normalized_valuation(
-                base_values *  random_valuation(num_of_items, item_subjective_ratio_bounds),
-                normalized_sum_of_values
-            )))
-            for agent in agents
-        }
+        agent_capacities  = dict(zip(agents, rng.randint(agent_capacity_bounds[0], agent_capacity_bounds[1]+1, size=num_of_agents).tolist()))
+        item_capacities   = dict(zip(items, rng.randint(item_capacity_bounds[0], item_capacity_bounds[1]+1, size=num_of_items).tolist()))
+        base_values = normalized_valuation(random_valuation(num_of_items, item_base_value_bounds, rng=rng), normalized_sum_of_values)
+        # All subjective ratios are drawn at once (row i belongs to agent i), and all rows are normalized together:
+        value_matrix = normalized_valuation(
+            base_values * random_valuation(num_of_items, item_subjective_ratio_bounds, num_of_agents, rng=rng),
+            normalized_sum_of_values
+        )
+        valuations = {agent: dict(zip(items, agent_values)) for agent,agent_values in zip(agents, value_matrix)}
         return Instance(valuations=valuations, agent_capacities=agent_capacities, item_capacities=item_capacities)
     
 
@@ -259,7 +261,7 @@ class Instance:
         """
         if random_seed is None:
             random_seed = np.random.randint(1, 2**31)
-        np.random.seed(random_seed)
+        rng = np.random.RandomState(random_seed)
         logger.info("Random seed: %d", random_seed)
 
         item_capacity = np.round((supply_ratio * agent_capacity * num_of_agents) / num_of_items)
@@ -270,16 +272,16 @@ class Instance:
         valuations = {}
         for agent in agents:
             # copied from https://github.com/marketdesignresearch/Course-Match-Preference-Simulator/blob/main/preference_generator.py
-            if np.random.uniform(0,1) <= mean_num_of_favorite_items - np.floor(mean_num_of_favorite_items):
+            if rng.uniform(0,1) <= mean_num_of_favorite_items - np.floor(mean_num_of_favorite_items):
                 num_of_favorite_items = int(np.ceil(mean_num_of_favorite_items))
             else:
                 num_of_favorite_items = int(np.floor(mean_num_of_favorite_items))
 
-            favorite_items = np.random.choice(num_of_popular_items, num_of_favorite_items, replace=False)
-            valuation = np.zeros(num_of_items)
-            for item_index in range(num_of_items):
-                value_bounds = favorite_item_value_bounds if item_index in favorite_items else nonfavorite_item_value_bounds
-                valuation[item_index] = np.random.uniform(low=value_bounds[0], high=value_bounds[1]+1)
+            favorite_items = rng.choice(num_of_popular_items, num_of_favorite_items, replace=False)
+            is_favorite = np.isin(np.arange(num_of_items), favorite_items)
+            low_values  = np.where(is_favorite, favorite_item_value_bounds[0], nonfavorite_item_value_bounds[0])
+            high_values = np.where(is_favorite, favorite_item_value_bounds[1], nonfavorite_item_value_bounds[1]) + 1
+            valuation = rng.uniform(low=low_values, high=high_values)   # one draw per item, in the same order as item-by-item sampling
             valuations[agent] = dict(zip(items, normalized_valuation(valuation, normalized_sum_of_values)))
 
         return Instance(valuations=valuations, agent_capacities=agent_capacity, item_capacities=item_capacity)
@@ -301,7 +303,7 @@ class Instance:
         """
         if random_seed is None:
             random_seed = np.random.randint(1, 2**31)
-        np.random.seed(random_seed)
+        rng = np.random.RandomState(random_seed)
         logger.info("Random seed: %d", random_seed)
         prototype_agents = list(prototype_valuations.keys())
 
@@ -326,7 +328,7 @@ class Instance:
         # Next, add random copies until one of the max_ values is hit:
         i = 1
         while True:
-            prototype_agent = np.random.choice(prototype_agents)
+            prototype_agent = rng.choice(prototype_agents)
             new_agent = f"random{i}.{prototype_agent}"
             add_agent(new_agent, prototype_agent)
             if max_total_agent_capacity<=0:
@@ -341,18 +343,33 @@ class Instance:
 
         
 
-def random_valuation(numitems:int, item_value_bounds: tuple[float,float])->np.ndarray:
+def random_valuation(numitems:int, item_value_bounds: tuple[float,float], numagents:int=None, rng=np.random)->np.ndarray:
     """
+    Draw a random valuation vector; if numagents is given, draw a matrix with one valuation per row.
+    The values are drawn from rng (by default, the global numpy random state).
+
     >>> r = random_valuation(10, [30, 40])
     >>> len(r)
     10
     >>> all(r>=30)
     True
+    >>> random_valuation(10, [30, 40], numagents=3).shape
+    (3, 10)
     """
-    return np.random.uniform(low=item_value_bounds[0], high=item_value_bounds[1]+1, size=numitems)
+    size = numitems if numagents is None else (numagents, numitems)
+    return rng.uniform(low=item_value_bounds[0], high=item_value_bounds[1]+1, size=size)
 
 def normalized_valuation(raw_valuations:np.ndarray, normalized_sum_of_values:float):
-    raw_sum_of_values = sum(raw_valuations)
+    """
+    Scale a valuation vector (or each row of a valuation matrix) to the given sum, and round to integers.
+
+    >>> normalized_valuation(np.array([1, 3]), 100)
+    array([25, 75])
+    >>> normalized_valuation(np.array([[1, 3], [2, 2]]), 100)
+    array([[25, 75],
+           [50, 50]])
+    """
+    raw_sum_of_values = np.sum(raw_valuations, axis=-1, keepdims=True)
     return  np.round(raw_valuations * normalized_sum_of_values / raw_sum_of_values).astype(int)
 
 
@@ -463,8 +480,15 @@ def get_keys_and_mapping_2d(container: any) -> tuple[list,callable]:
         # f = lambda agent,item: container.get(agent,dict()).get(item,0)
         # f = lambda agent,item: container[agent].get(item,0)
         # f = lambda agent,item: container[agent][item]
-        f = lambda agent,item: \
-            container[agent].get(item,0) if isinstance(container[agent],dict) else container[agent][item]
+        # The row type is checked once here, rather than on every call (agent_item_value is called very often):
+        row_is_dict = [isinstance(row,dict) for row in container.values()]
+        if all(row_is_dict):
+            f = lambda agent,item: container[agent].get(item,0)
+        elif not any(row_is_dict):
+            f = lambda agent,item: container[agent][item]
+        else:
+            f = lambda agent,item: \
+                container[agent].get(item,0) if isinstance(container[agent],dict) else container[agent][item]
         k1 = container.keys()
         k2, _ = get_keys_and_mapping(container[next(iter(container))])
     elif isinstance(container,list):
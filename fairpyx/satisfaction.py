@@ -8,8 +8,6 @@ Since: 2023-07
 from fairpyx import Instance
 import numpy as np
 
-from functools import cache
-
 
 class AgentBundleValueMatrix:
 
@@ -44,6 +42,8 @@ class AgentBundleValueMatrix:
         1
         >>> matrix.count_agents_with_top_rank(2)
         2
+        >>> matrix.top_ranks.tolist()
+        [2, 1]
         """
         self.instance = instance
         self.agents = instance.agents
@@ -66,6 +66,8 @@ class AgentBundleValueMatrix:
             agent: sorted(allocation[agent], key=self.rankings[agent].__getitem__)
             for agent in instance.agents
         }
+        # The rank of each agent's best item (see top_rank), as a dense vector:
+        self.top_ranks = np.array([self.top_rank(agent) for agent in self.agents])
         self.normalized_matrix = {
             agent1: {
                 agent2: self.raw_matrix[agent1][agent2] / self.maximum_values[agent1] * 100
@@ -127,7 +129,6 @@ class AgentBundleValueMatrix:
     def egalitarian_value(self):
         return min([self.matrix[agent][agent] for agent in self.agents])
 
-    @cache
     def agent_deficit(self, agent):
         """ A "deficit" is the number of courses the agent received below its capacity. """
         return self.instance.agent_capacity(agent) - len(self.allocation[agent])
@@ -138,7 +139,6 @@ class AgentBundleValueMatrix:
     def max_deficit(self):
         return max([self.agent_deficit(agent) for agent in self.agents])
 
-    @cache
     def top_rank(self, agent):
         if len(self.allocation[agent])>0:
             return self.rankings[agent][self.allocation[agent][0]]
@@ -146,7 +146,7 @@ class AgentBundleValueMatrix:
             return np.inf
     
     def count_agents_with_top_rank(self, rank=1):
-        return sum([self.top_rank(agent)<=rank for agent in self.agents])
+        return int(np.count_nonzero(self.top_ranks<=rank))
 
     def explain(self, explanation_logger, map_course_to_name:dict={}):
         """
@@ -74,15 +74,15 @@ def many_to_many_matching_using_network_flow(items:list, item_capacity: callable
     flow = nx.max_flow_min_cost(graph, "s", "t", capacity="capacity", weight="weight")
 
     ### c. Convert the flow to a many-to-many matching:
+    map_node_to_item = {item_str(item): item for item in items}
     map_agent_name_to_bundle = {}
     for agent in agents:
         map_agent_name_to_bundle[agent] = []
-        for item in items:
-            agent_item_flow =  flow[agent_str(agent)].get(item_str(item),0)
+        for item_node,agent_item_flow in flow[agent_str(agent)].items():   # only the edges that exist in the network
             if agent_item_flow==1:
-                map_agent_name_to_bundle[agent].append(item)
+                map_agent_name_to_bundle[agent].append(map_node_to_item[item_node])
             elif agent_item_flow!=0:
-                raise ValueError(f"non-binary flow in network: agent={agent}, item={item}, flow={itemflow}.\n Entire flow: {flow}")
+                raise ValueError(f"non-binary flow in network: agent={agent}, item={map_node_to_item[item_node]}, flow={agent_item_flow}.\n Entire flow: {flow}")
         map_agent_name_to_bundle[agent].sort()
     return map_agent_name_to_bundle
 
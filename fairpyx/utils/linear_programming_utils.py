@@ -6,49 +6,160 @@ Since: 2023-07
 """
 
 from fairpyx import Instance
-import cvxpy
+import cvxpy, numpy as np, scipy.sparse
+
+def allocation_values(instance: Instance)->tuple:
+    """
+    Construct the raw and the normalized value matrices of the instance.
+    Row i of each matrix corresponds to the i-th agent in instance.agents, and column j to the j-th item in instance.items.
+
+    >>> instance = Instance(valuations={"avi": {"x":5, "y":4}, "beni": {"x":2, "y":3}})
+    >>> raw_values, normalized_values = allocation_values(instance)
+    >>> raw_values.tolist()
+    [[5.0, 4.0], [2.0, 3.0]]
+    >>> np.round(normalized_values).tolist()
+    [[56.0, 44.0], [40.0, 60.0]]
+    """
+    agents = list(instance.agents)
+    items  = list(instance.items)
+    raw_values = np.array([[instance.agent_item_value(agent,item) for item in items] for agent in agents], dtype=float)
+    # Normalize all rows at once, with the same rules as instance.agent_normalized_item_value:
+    maximum_values = np.array([instance.agent_maximum_value(agent) for agent in agents], dtype=float)[:,np.newaxis]
+    if np.any((maximum_values==0) & (raw_values>0)):
+        raise ValueError("Some agent has a positive value for an item, but its max value is 0")
+    with np.errstate(divide="ignore", invalid="ignore"):
+        normalized_values = np.where(maximum_values==0, 0, raw_values / maximum_values * 100)
+    if np.any(np.isnan(normalized_values)):
+        raise ValueError("Some normalized values are nan")
+    return raw_values, normalized_values
 
 def allocation_variables(instance: Instance)->tuple:
     """
-    Construct cvxpy variables representing a fractional allocation, and construct expressions representing the utilities.
-
-    :return allocation_vars, raw_utilities, normalized_utilities
-    """
-    allocation_vars = {agent: {item: cvxpy.Variable() for item in instance.items} for agent in instance.agents}
-    raw_utilities = {
-        agent:
-        sum([allocation_vars[agent][item] * instance.agent_item_value(agent,item) for item in instance.items])
-        for agent in instance.agents
-    }
-    normalized_utilities = {
-        agent:
-        sum([allocation_vars[agent][item] * instance.agent_normalized_item_value(agent,item) for item in instance.items])
-        for agent in instance.agents
-    }
+    Construct a cvxpy matrix variable representing a fractional allocation, and construct expressions representing the utilities.
+    Row i of the matrix corresponds to the i-th agent in instance.agents, and column j to the j-th item in instance.items.
+
+    :return allocation_vars, raw_utilities, normalized_utilities (the utilities are vector expressions, with one entry per agent).
+
+    >>> instance = Instance(valuations={"avi": {"x":5, "y":4}, "beni": {"x":2, "y":3}})
+    >>> allocation_vars, raw_utilities, normalized_utilities = allocation_variables(instance)
+    >>> allocation_vars.shape
+    (2, 2)
+    >>> raw_utilities.shape
+    (2,)
+    """
+    raw_values, normalized_values = allocation_values(instance)
+    allocation_vars = cvxpy.Variable(raw_values.shape)
+    raw_utilities = cvxpy.sum(cvxpy.multiply(raw_values, allocation_vars), axis=1)
+    normalized_utilities = cvxpy.sum(cvxpy.multiply(normalized_values, allocation_vars), axis=1)
     return allocation_vars, raw_utilities, normalized_utilities
 
-def allocation_constraints(instance: Instance, allocation_vars:list):
+def conflicting_item_pairs(instance: Instance, item_index:dict)->list:
+    """
+    List the pairs of conflicting items, as pairs of item indices (j1,j2) with j1<j2.
+    Conflicts are usually listed in both directions; each pair appears only once. Self-conflicts are ignored.
+
+    :param item_index: maps each item to its index (column) in the allocation matrix.
+
+    >>> instance = Instance(valuations=[[4,3,1,2]], item_conflicts={0: [1,2], 1: [0], 2: [0,2], 3: [5]})
+    >>> conflicting_item_pairs(instance, {item: j for j,item in enumerate(instance.items)})
+    [(0, 1), (0, 2)]
+    """
+    pairs = set()
+    for item in instance.items:
+        for conflicting_item in instance.item_conflicts(item):
+            if conflicting_item in item_index and conflicting_item != item:
+                j1, j2 = item_index[item], item_index[conflicting_item]
+                pairs.add((min(j1,j2), max(j1,j2)))
+    return sorted(pairs)
+
+def capacity_vectors(instance: Instance)->tuple:
+    """
+    :return item_capacities, agent_capacities: vectors ordered as instance.items and instance.agents.
+
+    >>> instance = Instance(valuations=[[4,3,1],[2,2,2]], item_capacities=[1,2,3], agent_capacities=2)
+    >>> item_capacities, agent_capacities = capacity_vectors(instance)
+    >>> item_capacities.tolist(), agent_capacities.tolist()
+    ([1.0, 2.0, 3.0], [2.0, 2.0])
+    """
+    item_capacities  = np.array([instance.item_capacity(item) for item in instance.items], dtype=float)
+    agent_capacities = np.array([instance.agent_capacity(agent) for agent in instance.agents], dtype=float)
+    return item_capacities, agent_capacities
+
+def allocation_upper_bounds(instance: Instance, item_index:dict)->np.ndarray:
+    """
+    The maximum fraction of each item that each agent may get:
+    at most one unit of each item, and no units of items in conflict with the agent.
+
+    :param item_index: maps each item to its index (column) in the allocation matrix.
+
+    >>> instance = Instance(valuations=[[4,3,1],[2,2,2]], agent_conflicts={1: [2]})
+    >>> allocation_upper_bounds(instance, {item: j for j,item in enumerate(instance.items)}).tolist()
+    [[1.0, 1.0, 1.0], [1.0, 1.0, 0.0]]
+    """
+    upper_bounds = np.ones((len(list(instance.agents)), len(item_index)))
+    for i,agent in enumerate(instance.agents):
+        for item in instance.agent_conflicts(agent):
+            if item in item_index:
+                upper_bounds[i,item_index[item]] = 0
+    return upper_bounds
+
+def allocation_constraints(instance: Instance, allocation_vars:cvxpy.Variable):
     """
     Construct cvxpy constraints for a feasible fractional allocation:
-    item_capacity_constraints, agent_capacity_constraints, positivity_constraints, uniqueness_constraints.
+    item_capacity_constraints, agent_capacity_constraints, positivity_constraints, uniqueness_constraints, conflict_constraints.
+    The capacity constraints are two vector constraints (one over all items and one over all agents),
+    and each conflict constraint is a vector constraint over all agents.
 
     :return a list of all constraints
     """
-    item_capacity_constraints = [
-        sum([allocation_vars[agent][item] for agent in instance.agents]) <= instance.item_capacity(item)
-        for item in instance.items
-    ]
-    agent_capacity_constraints = [
-        sum([allocation_vars[agent][item] for item in instance.items]) <= instance.agent_capacity(agent)
-        for agent in instance.agents
+    item_capacities, agent_capacities = capacity_vectors(instance)
+    item_capacity_constraints  = [cvxpy.sum(allocation_vars, axis=0) <= item_capacities]   # one vector constraint for all items
+    agent_capacity_constraints = [cvxpy.sum(allocation_vars, axis=1) <= agent_capacities]  # one vector constraint for all agents
+    item_index = {item: j for j,item in enumerate(instance.items)}
+    positivity_constraints = [0 <= allocation_vars]
+    uniqueness_constraints = [allocation_vars <= allocation_upper_bounds(instance, item_index)]
+    conflict_constraints = [  # an agent cannot get (in total) more than one unit of two conflicting items
+        allocation_vars[:,j1] + allocation_vars[:,j2] <= 1
+        for (j1,j2) in conflicting_item_pairs(instance, item_index)
     ]
-    positivity_constraints = [
-        0 <= allocation_vars[agent][item] for agent in instance.agents for item in instance.items
-    ]
-    uniqueness_constraints = [
-        allocation_vars[agent][item] <= 1 for agent in instance.agents for item in instance.items
-    ]
-    return item_capacity_constraints + agent_capacity_constraints + positivity_constraints + uniqueness_constraints
+    return item_capacity_constraints + agent_capacity_constraints + positivity_constraints + uniqueness_constraints + conflict_constraints
+
+
+def allocation_matrix_constraints(instance: Instance)->tuple:
+    """
+    Construct the same constraints as allocation_constraints, in the matrix form used by scipy.optimize.linprog.
+    The variables are the entries of the allocation matrix flattened row by row:
+    the fraction of the j-th item given to the i-th agent is variable number i*num_of_items+j.
+
+    :return A_ub, b_ub, bounds, such that the feasible allocations are the vectors x with A_ub @ x <= b_ub and x within bounds.
+       A_ub is a sparse matrix; bounds is an array with a (lower, upper) row per variable.
+
+    >>> instance = Instance(valuations=[[4,3,1],[2,2,2]], item_conflicts={0: [1], 1: [0]}, agent_conflicts={1: [2]})
+    >>> A_ub, b_ub, bounds = allocation_matrix_constraints(instance)
+    >>> A_ub.shape    # 3 item capacities, 2 agent capacities, 2 agents times 1 conflicting pair
+    (7, 6)
+    >>> bounds[:,1].tolist()
+    [1.0, 1.0, 1.0, 1.0, 1.0, 0.0]
+    """
+    num_of_agents, num_of_items = len(list(instance.agents)), len(list(instance.items))
+    item_capacities, agent_capacities = capacity_vectors(instance)
+    item_index = {item: j for j,item in enumerate(instance.items)}
+
+    item_capacity_rows  = scipy.sparse.kron(np.ones((1,num_of_agents)), scipy.sparse.identity(num_of_items))   # sum of column j
+    agent_capacity_rows = scipy.sparse.kron(scipy.sparse.identity(num_of_agents), np.ones((1,num_of_items)))   # sum of row i
+
+    conflict_pairs = conflicting_item_pairs(instance, item_index)
+    conflict_matrix = scipy.sparse.lil_matrix((len(conflict_pairs), num_of_items))
+    for p,(j1,j2) in enumerate(conflict_pairs):
+        conflict_matrix[p,j1] = conflict_matrix[p,j2] = 1
+    conflict_rows = scipy.sparse.kron(scipy.sparse.identity(num_of_agents), conflict_matrix)   # for each agent, for each conflicting pair
+
+    A_ub = scipy.sparse.vstack([item_capacity_rows, agent_capacity_rows, conflict_rows], format="csr")
+    b_ub = np.concatenate([item_capacities, agent_capacities, np.ones(conflict_rows.shape[0])])
+
+    upper_bounds = allocation_upper_bounds(instance, item_index)
+    bounds = np.column_stack([np.zeros(num_of_agents*num_of_items), upper_bounds.ravel()])
+    return A_ub, b_ub, bounds
 
 
 
@@ -6,11 +6,11 @@ Programmer: Erel Segal-Halevi.
 Since: 2023-07
 """
 
-from fairpyx.instance import Instance
-from fairpyx.linear_programming_utils import allocation_variables, allocation_constraints
+from fairpyx import Instance
+from fairpyx.utils.linear_programming_utils import allocation_variables, allocation_constraints
 
 import cvxpy
-from fairpyx.solve import solve
+from fairpyx.utils.solve import solve
 from cvxpy_leximin import Problem, Leximin
 
 
@@ -71,14 +71,15 @@ def fractional_leximin_optimal_allocation(instance: Instance, normalize_utilitie
     allocation_vars, raw_utilities, normalized_utilities = allocation_variables(instance)
     utilities = normalized_utilities if normalize_utilities else raw_utilities
     problem = Problem(
-        Leximin(utilities.values()),
+        Leximin([utilities[i] for i in range(utilities.shape[0])]),   # one utility expression per agent
         constraints=allocation_constraints(instance, allocation_vars),
         upper_tolerance=1.01,
         lower_tolerance=0.99,
         **solver_options
     )
     solve(problem, solvers = [(cvxpy.SCIPY, {'method':'highs-ds'})])  # highs-ds is a variant of simplex (guaranteed to return a corner solution)
-    allocation_matrix = {agent: {item: allocation_vars[agent][item].value+0 for item in instance.items} for agent in instance.agents}
+    allocation_values = allocation_vars.value+0   # row i is the i-th agent, column j is the j-th item
+    allocation_matrix = {agent: {item: allocation_values[i,j] for j,item in enumerate(instance.items)} for i,agent in enumerate(instance.agents)}
     # logger.debug("\nAllocation_matrix:\n%s", allocation_matrix)
     # logger.debug("\nRaw utilities:\n%s", {agent: raw_utilities[agent].value+0 for agent in instance.agents})
     # logger.debug("\nMax utilities:\n%s", {agent: instance.agent_maximum_value(agent) for agent in instance.agents})
@@ -19,16 +19,133 @@ between courses for students given a list of preferences for each student.
 import logging
 import math
 import numpy as np
-from fairpyx.valuations import ValuationMatrix
-from fairpyx.allocation_utils import AllocationBuilder
+from itertools import chain, combinations
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from scipy.optimize import milp, LinearConstraint, Bounds
+from fairpyx import AllocationBuilder
 from queue import PriorityQueue
-import cvxpy as cp
 
 
 logger = logging.getLogger(__name__)
 
 
 Epsilon = 0.01
+PRICE_TOLERANCE = 1e-9   # bundle prices are sums of floats, so a bundle is affordable if its price exceeds the budget by at most this amount
+MAX_BUNDLES = 100_000    # with more bundles than this per student, solving an integer program is faster than enumerating all bundles
+
+
+@lru_cache(maxsize=None)
+def bundle_matrix(num_of_items: int, capacity: int) -> np.ndarray:
+    """
+    Return a 0/1 matrix with a row for every bundle of at most `capacity` items (including the empty bundle).
+    Row b has 1 in column i if bundle b contains item i; the entries are int8, so the matrix takes one byte per entry.
+    The matrix depends only on the two sizes, so it is computed once and shared (it is read-only).
+
+    >>> bundle_matrix(3, 2).tolist()
+    [[0, 0, 0], [1, 0, 0], [0, 1, 0], [0, 0, 1], [1, 1, 0], [1, 0, 1], [0, 1, 1]]
+    >>> bundle_matrix(3, 2) is bundle_matrix(3, 2)
+    True
+    """
+    sizes = range(min(capacity, num_of_items)+1)
+    num_of_bundles = sum(math.comb(num_of_items, size) for size in sizes)
+    if num_of_items <= 64:
+        # Each bundle fits in one uint64 mask. The masks are unpacked into rows bit by bit,
+        # using only the bytes that hold the items, so the temporary array is not larger than the result:
+        masks = np.fromiter(chain.from_iterable(bundle_masks(num_of_items, size) for size in sizes), dtype="<u8", count=num_of_bundles)
+        num_of_bytes = (num_of_items + 7) // 8
+        bits = np.unpackbits(masks.view(np.uint8).reshape(-1, 8)[:, :num_of_bytes], axis=1, bitorder="little")
+        matrix = np.ascontiguousarray(bits[:, num_of_items-1::-1]).view(np.int8)   # bit j is item num_of_items-1-j
+    else:
+        matrix = np.zeros((num_of_bundles, num_of_items), dtype=np.int8)
+        bundles = chain.from_iterable(combinations(range(num_of_items), size) for size in sizes)   # generated lazily, straight into the matrix
+        for row, bundle in enumerate(bundles):
+            matrix[row, list(bundle)] = 1
+    matrix.flags.writeable = False
+    return matrix
+
+
+def number_of_bundles(num_of_items: int, capacity: int) -> int:
+    """
+    The number of bundles of at most `capacity` items, i.e., the number of rows of bundle_matrix(num_of_items, capacity).
+
+    >>> number_of_bundles(3, 2)
+    7
+    """
+    return sum(math.comb(num_of_items, size) for size in range(min(capacity, num_of_items)+1))
+
+
+def solve_bundle_program(objective: np.ndarray, constraint_matrix: np.ndarray, lower_limits: list[float], upper_limits: list[float],
+                         fixed_items: dict[int, int] = {}) -> np.ndarray:
+    """
+    Find a bundle x (a 0/1 vector) that minimizes objective @ x subject to lower_limits <= constraint_matrix @ x <= upper_limits,
+    and x[item] = value for every item, value in fixed_items.
+    This integer program is used instead of bundle_matrix when there are more than MAX_BUNDLES bundles.
+
+    :return the bundle as an int8 vector, or None if no bundle satisfies the constraints.
+
+    >>> solve_bundle_program(-np.array([60,30,6,4]), np.array([[1.1,0.9,0.1,0.0],[1,1,1,1]]), [-np.inf,-np.inf], [1.1,2]).tolist()
+    [1, 0, 0, 1]
+    >>> solve_bundle_program(-np.array([60,30,6,4]), np.array([[1.1,0.9,0.1,0.0],[1,1,1,1]]), [-np.inf,-np.inf], [1.0,2], {0: 1}) is None
+    True
+    """
+    num_of_items = len(objective)
+    if num_of_items == 0:   # milp needs at least one variable; the only bundle is the empty one
+        is_feasible = np.all(np.asarray(lower_limits) <= 0) and np.all(np.asarray(upper_limits) >= 0)
+        return np.zeros(0, dtype=np.int8) if is_feasible else None
+    lower_bounds, upper_bounds = np.zeros(num_of_items), np.ones(num_of_items)
+    for item, value in fixed_items.items():
+        lower_bounds[item] = upper_bounds[item] = value
+    result = milp(objective, constraints=LinearConstraint(constraint_matrix, lower_limits, upper_limits),
+                  integrality=np.ones(num_of_items), bounds=Bounds(lower_bounds, upper_bounds))
+    if not result.success:
+        return None
+    return np.round(result.x).astype(np.int8)
+
+
+def bundle_values(utility: tuple[float], capacity: int, cache: dict = None) -> np.ndarray:
+    """
+    Return the value of every bundle in bundle_matrix(len(utility), capacity) for a student with the given item utilities.
+    The values depend only on the student's utilities, which do not change during the search,
+    so when a cache dict is given, they are stored in it and shared between all price vectors.
+    course_allocation owns the cache of a search, so it is released when the search ends.
+
+    >>> bundle_values((60.0, 30.0, 6.0), 2).tolist()
+    [0.0, 60.0, 30.0, 6.0, 90.0, 66.0, 36.0]
+    >>> cache = {}
+    >>> bundle_values((60.0, 30.0, 6.0), 2, cache) is bundle_values((60.0, 30.0, 6.0), 2, cache)
+    True
+    """
+    if cache is not None and (utility, capacity) in cache:
+        return cache[(utility, capacity)]
+    values = bundle_matrix(len(utility), capacity) @ np.array(utility, dtype=float)
+    if cache is not None:
+        cache[(utility, capacity)] = values
+    return values
+
+
+def bundle_masks(num_of_items: int, size: int) -> list[int]:
+    """
+    Return all bundles of exactly `size` items as bit masks, where item i is bit (num_of_items-1-i),
+    in the same order as itertools.combinations. The masks are enumerated with Gosper's hack.
+
+    >>> [bin(mask) for mask in bundle_masks(4, 2)]
+    ['0b1100', '0b1010', '0b1001', '0b110', '0b101', '0b11']
+    >>> bundle_masks(3, 0)
+    [0]
+    """
+    if size == 0:
+        return [0]
+    masks = []
+    mask = (1 << size) - 1      # the smallest mask with `size` bits
+    limit = 1 << num_of_items
+    while mask < limit:
+        masks.append(mask)
+        lowest = mask & -mask
+        ripple = mask + lowest
+        mask = (((ripple ^ mask) >> 2) // lowest) | ripple   # the next larger mask with the same number of bits
+    masks.reverse()     # descending masks are the lexicographic order of the item combinations
+    return masks
 
 
 def general_course_allocation(
@@ -61,7 +178,7 @@ def general_course_allocation(
 
     budgets = [1 + np.random.randint(1, 100)/100 for agent in alloc.remaining_agents()]
     prices  = [np.random.randint(1, 100)/100 for item in alloc.remaining_items()]
-    utilities = ValuationMatrix([
+    utilities = np.array([
         [alloc.effective_value(agent,item) for item in alloc.remaining_items()]
         for agent in alloc.remaining_agents()
     ])
@@ -81,9 +198,10 @@ def general_course_allocation(
 general_course_allocation.logger = logger
 
 
-def course_allocation(utilities:ValuationMatrix, budgets: list[float], prices: list[float], 
+def course_allocation(utilities: np.ndarray, budgets: list[float], prices: list[float], 
                       item_capacity: list[int], agent_capacity: list[int], 
-                      bound: int = 0, effect_variables: list[dict[set, int]] = None, constraint: list[dict[set, int]] = None) \
+                      bound: int = 0, effect_variables: list[dict[set, int]] = None, constraint: list[dict[set, int]] = None,
+                      max_iterations: int = 100, max_workers: int = 1) \
         -> list[list[bool]]:
     """
     The main function.
@@ -94,150 +212,184 @@ def course_allocation(utilities:ValuationMatrix, budgets: list[float], prices: l
     The search continues as long as the SCORE is greater than the desired bound.
     At the end of the search, the vector will determine the optimal price, according to which the
     program will output the optimal course package for each student.
+    The search also stops after max_iterations iterations, or when there are no unvisited price vectors left.
+    The neighbors of each step are evaluated by max_workers threads.
 
     Example 1: simple example.
-    >>> course_allocation(ValuationMatrix([[60,30,6,4],[62,32,4,2]]),[1.1,1.0],[1.1,0.9,0.1,0.0],[1,1,1,1], [2,2])
+    >>> course_allocation(np.array([[60,30,6,4],[62,32,4,2]]),[1.1,1.0],[1.1,0.9,0.1,0.0],[1,1,1,1], [2,2])
     [[1, 0, 0, 1], [0, 1, 1, 0]]
 
     Example 2: input that cannot be divided equally. GLPK ERROR!
-    >>> course_allocation(ValuationMatrix([[30, 70], [55, 45], [80, 20]]), [1.0, 1.1, 1.2], [1.2, 1.0], [1, 1], [1,1,1])
+    >>> course_allocation(np.array([[30, 70], [55, 45], [80, 20]]), [1.0, 1.1, 1.2], [1.2, 1.0], [1, 1], [1,1,1])
     [[0, 0], [0, 1], [1, 0]]
 
     Example 3: input that can be divided equally.
-    >>> course_allocation(ValuationMatrix([[36, 35, 13, 10, 4, 2], [1, 3, 43, 37, 7, 9], [5, 13, 12, 17, 25, 28]]), [1.3, 1.1, 1.5], [0.9, 0.3, 0.9, 1.1, 1.0, 0.2], [1,1,1,1,1,1], [2,2,2])
+    >>> course_allocation(np.array([[36, 35, 13, 10, 4, 2], [1, 3, 43, 37, 7, 9], [5, 13, 12, 17, 25, 28]]), [1.3, 1.1, 1.5], [0.9, 0.3, 0.9, 1.1, 1.0, 0.2], [1,1,1,1,1,1], [2,2,2])
     [[1, 1, 0, 0, 0, 0], [0, 0, 1, 1, 0, 0], [0, 0, 0, 0, 1, 1]]
 
     Example 4: input with popular courses.
-    >>> course_allocation(ValuationMatrix([[49, 40, 8, 3], [53, 29, 15, 3], [61, 30, 7, 2]]), [0.7, 1.2, 1.3], [0.2, 0.4, 0.2, 0.6], [2,2,2,2], [2,2,2])
+    >>> course_allocation(np.array([[49, 40, 8, 3], [53, 29, 15, 3], [61, 30, 7, 2]]), [0.7, 1.2, 1.3], [0.2, 0.4, 0.2, 0.6], [2,2,2,2], [2,2,2])
     [[0, 1, 1, 0], [1, 0, 1, 0], [1, 1, 0, 0]]
     """
 
     logger.debug('course_allocation function')
 
     q = PriorityQueue()
-    tabu = []
+    bundle_values_cache = {}   # the bundle values of each student, shared by all steps of this search
+    tabu = {tuple(prices)}   # the price vectors that were already visited or queued (as tuples, for constant-time lookup)
     curr_node: Course_Bundle = Course_Bundle(utilities, budgets, prices, item_capacity, agent_capacity)
     best_node = curr_node
 
     counter = 0
-    max_iterations = 100
 
     while best_node.score() > bound:
 
         if counter == max_iterations:
             break
 
-        tabu.append(curr_node)
-        for p in curr_node.neighbors():
-            q.put(Course_Bundle(utilities, budgets, p, item_capacity, agent_capacity))
-
+        # Evaluate only the neighbors that were not visited or queued before, so each price vector enters the queue at most once:
+        neighbor_prices = []
+        for neighbor in curr_node.neighbors(bundle_values_cache):
+            signature = tuple(neighbor)
+            if signature not in tabu:
+                tabu.add(signature)
+                neighbor_prices.append(neighbor)
+        if neighbor_prices:
+            neighbor_placements = max_utilities_for_prices(utilities, budgets, neighbor_prices, agent_capacity, max_workers, bundle_values_cache)   # all neighbors at once
+            for p, placement in zip(neighbor_prices, neighbor_placements):
+                q.put(Course_Bundle(utilities, budgets, p, item_capacity, agent_capacity, placement))
+
+        if q.empty():   # q.get() would block forever
+            logger.warning('All neighbors were already visited - stopping after %d iterations', counter)
+            break
         curr_node = q.get()
-        while tabu.__contains__(curr_node):
-            curr_node = q.get()
 
-        if curr_node.score() < best_node.score():
-            logger.info('The new best_node score is: %g', best_node.score())
+        if curr_node < best_node:
             best_node = curr_node
+            logger.info('The new best_node score is: %g', best_node.score())
 
         counter += 1
 
-    return best_node.placement
+    return best_node.placement.tolist()
 
 
 def neighbors(utilities, budgets: list[float], prices: list[float], 
               item_capacity: list[int], agent_capacity:list[int],
-              effect_variables: list[dict[set, int]] = None, constraint: list[dict[set, int]] = None) \
+              effect_variables: list[dict[set, int]] = None, constraint: list[dict[set, int]] = None,
+              placement: list[list[bool]] = None, bundle_values_cache: dict = None) \
         -> list[list[float]]:
     """
     The neighbors function receives a current price vector, and produces for it a list of
     price vectors that are close to it according to the algorithm described in the article,
     where the goal is to produce a price vector that will reduce the gap between the demand
     and supply of the courses as much as possible.
+    If the placement induced by the current prices is already known, it can be given, so it is not computed again.
+    bundle_values_cache is passed to bundle_values.
 
     Example 1:
-    >>> neighbors(ValuationMatrix([[30, 70], [55, 45], [80, 20]]), [1.0, 1.1, 1.2], [1.2, 1.0], [1, 1], [1,1,1])
+    >>> neighbors(np.array([[30, 70], [55, 45], [80, 20]]), [1.0, 1.1, 1.2], [1.2, 1.0], [1, 1], [1,1,1])
     [[0, 1], [1.2, 1.01]]
 
     Example 2:
-    >>> neighbors(ValuationMatrix([[36, 35, 13, 10, 4, 2], [1, 3, 43, 37, 7, 9], [5, 13, 12, 17, 25, 28]]), [1.3, 1.1, 1.5], [0.9, 0.3, 0.9, 1.1, 1.0, 0.2], [1,1,1,1,1,1], [2,2,2])
+    >>> neighbors(np.array([[36, 35, 13, 10, 4, 2], [1, 3, 43, 37, 7, 9], [5, 13, 12, 17, 25, 28]]), [1.3, 1.1, 1.5], [0.9, 0.3, 0.9, 1.1, 1.0, 0.2], [1,1,1,1,1,1], [2,2,2])
     [[0, 0, 0, -1, 0, 1], [0.9, 0.3, 0.9, 1.1, 1.0, 0.21]]
 
     Example 3:
-    >>> neighbors(ValuationMatrix([[49, 40, 8, 3], [53, 29, 15, 3], [61, 30, 7, 2]]), [1.0, 1.2, 1.3], [0.2, 0.5, 0.4, 0.6], [2,2,2,2], [2,2,2])
+    >>> neighbors(np.array([[49, 40, 8, 3], [53, 29, 15, 3], [61, 30, 7, 2]]), [1.0, 1.2, 1.3], [0.2, 0.5, 0.4, 0.6], [2,2,2,2], [2,2,2])
     [[1, 1, -2, -2], [1.01, 0.5, 0.4, 0.6], [0.2, 0.81, 0.4, 0.6]]
+
+    Example 4: no price of course 0 makes its holders prefer another bundle, so only the gradient neighbor is returned:
+    >>> neighbors(np.array([[10, 10], [10, 10]]), [1.0, 1.0], [0.5, 0.6], [1, 1], [1, 1])
+    [[1, -1]]
     """
 
     logger.debug('neighbors function')
 
     neighbors_list = []
-    placement = max_utilities(utilities, budgets, prices, agent_capacity)
+    if placement is None:
+        placement = max_utilities(utilities, budgets, prices, agent_capacity)
     placement_sum = np.sum(placement, axis=0)
 
     # 1) find neighbor by gradiant:
-    gradiant = []
-
-    for index, size in enumerate(placement_sum):
-        if prices[index] > 0:
-            gradiant.append(size - item_capacity[index])
-        else:
-            gradiant.append(max(size - item_capacity[index], 0))
-    neighbors_list.append(gradiant)
+    excess_demand = placement_sum - np.asarray(item_capacity)
+    # A course with a non-positive price cannot get cheaper, so only its over-demand counts:
+    gradiant = np.where(np.asarray(prices) > 0, excess_demand, np.maximum(excess_demand, 0))
+    neighbors_list.append(gradiant.tolist())
 
     # 2) find neighbors for each individual price:
     courses_num = len(prices)
     students_num = len(budgets)
 
-    for item in range(0, courses_num):
-        # Checking whether the course has excess demand:
-        if item_capacity[item] < placement_sum[item]:
-
-            pi = math.inf
-
-            for agent in range(0, students_num):
-                # Checking whether the course belongs to the student's bundle:
-                if placement[agent][item] == 1:
-
-                    # 2.1) Looking for the package with the maximum value that *does not* contain the current course:
-                    x1 = cp.Variable(shape=(courses_num, 1), boolean=True)
-                    x1_price = sum(np.array(prices) @ x1)
-                    x1_utility = np.array(utilities[agent]) @ x1
-                    # x1_utility = sum([utilities[student][item] * x1[item] for item in range(len(courses_num))])
-                    objective1 = cp.Maximize(x1_utility)
-                    constraints = [
-                        x1_price <= budgets[agent],
-                        x1[item] == 0,
-                        sum(x1) <= agent_capacity[agent]
-                    ]
-                    prob = cp.Problem(objective1, constraints)
-                    prob.solve()
-                    # The maximum value of the package without the current course for the current student:
-                    O1 = prob.value
-                    logger.info('The maximum value without course %g for student %g is: %g', item, agent, O1)
-
-                    # 2.2) Looking for the package with the minimum price whose value is greater than O1 and contains the current course:
-                    x2 = cp.Variable(shape=(courses_num, 1), boolean=True)
-                    objective2 = cp.Minimize(np.array(prices) @ x2)
-                    constraints = [
-                        sum(np.array(utilities[agent]) @ x2) >= O1 + Epsilon,
-                        # sum([utilities[student][item] * x2[item] for item in range(len(courses_num))]) >= O1 + Epsilon,
-                        x2[item] == 1,
-                        sum(x2) <= agent_capacity[agent]
-                    ]
-                    prob = cp.Problem(objective2, constraints)
-                    prob.solve()
-                    O2 = prob.value
-                    logger.info('The minimum price with course %g for student %g is: %g', item, agent, O2)
-
-                    if (budgets[agent] - O2 + Epsilon) < pi:
-                        pi = budgets[agent] - O2 + Epsilon
-
-            new_prices = prices.copy()
-            new_prices[item] = round(prices[item] + pi, 3)
-            neighbors_list.append(new_prices)
+    over_demanded = [item for item in range(0, courses_num) if item_capacity[item] < placement_sum[item]]
+    pi = np.full(courses_num, math.inf)
+    price_vector = np.asarray(prices, dtype=float)
+    bundle_prices_of_capacity = {}    # the bundle prices are the same for all students with the same capacity
+
+    for agent in range(0, students_num):
+        # The over-demanded courses that belong to the student's bundle - all of them are handled at once:
+        held = [item for item in over_demanded if placement[agent][item] == 1]
+        if not held:
+            continue
+
+        if number_of_bundles(courses_num, agent_capacity[agent]) > MAX_BUNDLES:
+            O1, O2 = price_adjustment_bounds_by_integer_program(utilities[agent], budgets[agent], price_vector, agent_capacity[agent], held)
+        else:
+            bundles = bundle_matrix(courses_num, agent_capacity[agent])
+            values = bundle_values(tuple(np.asarray(utilities[agent], dtype=float).tolist()), agent_capacity[agent], bundle_values_cache)
+            if agent_capacity[agent] not in bundle_prices_of_capacity:
+                bundle_prices_of_capacity[agent_capacity[agent]] = bundles @ price_vector
+            bundle_prices = bundle_prices_of_capacity[agent_capacity[agent]]
+            contains_item = bundles[:, held] == 1     # one column per held course
+
+            # 2.1) Looking for the package with the maximum value that *does not* contain the course:
+            affordable = bundle_prices <= budgets[agent] + PRICE_TOLERANCE
+            # The maximum value of the package without the course for the current student (the empty bundle is always a candidate):
+            O1 = np.where(~contains_item & affordable[:, np.newaxis], values[:, np.newaxis], -np.inf).max(axis=0)
+
+            # 2.2) Looking for the package with the minimum price whose value is greater than O1 and contains the course:
+            better_bundles = contains_item & (values[:, np.newaxis] >= O1 + Epsilon)
+            O2 = np.where(better_bundles, bundle_prices[:, np.newaxis], np.inf).min(axis=0)
+        logger.info('The maximum values without courses %s for student %g are: %s', held, agent, O1)
+        logger.info('The minimum prices with courses %s for student %g are: %s', held, agent, O2)
+
+        pi[held] = np.minimum(pi[held], budgets[agent] - O2 + Epsilon)
+
+    for item in over_demanded:
+        if not math.isfinite(pi[item]):
+            # Some student holding the course has no better bundle with it at any price, so there is no price adjustment:
+            logger.info('No individual price adjustment for course %g', item)
+            continue
+        new_prices = prices.copy()
+        new_prices[item] = round(prices[item] + float(pi[item]), 3)
+        neighbors_list.append(new_prices)
 
     return neighbors_list
 
 
+def price_adjustment_bounds_by_integer_program(utility: list[float], budget: float, prices: np.ndarray, capacity: int, held: list[int]) -> tuple:
+    """
+    Compute the O1 and O2 values of the neighbors function for each of the given courses by integer programs,
+    for students with too many bundles to enumerate:
+    O1 is the maximum value of an affordable bundle without the course, and
+    O2 is the minimum price of a bundle with the course whose value is at least O1 + Epsilon (inf if there is none).
+
+    >>> price_adjustment_bounds_by_integer_program([60,30,6,4], 1.1, np.array([1.1,0.9,0.1,0.0]), 2, [0])
+    (array([36.]), array([1.1]))
+    """
+    utility = np.asarray(utility, dtype=float)
+    num_of_items = len(utility)
+    O1, O2 = np.zeros(len(held)), np.full(len(held), math.inf)
+    for index, item in enumerate(held):
+        best_without_item = solve_bundle_program(-utility, np.vstack([prices, np.ones(num_of_items)]),
+                                                 [-np.inf, -np.inf], [budget + PRICE_TOLERANCE, capacity], {item: 0})
+        O1[index] = utility @ best_without_item    # the empty bundle is always feasible
+        cheapest_better_bundle = solve_bundle_program(prices, np.vstack([utility, np.ones(num_of_items)]),
+                                                      [O1[index] + Epsilon, -np.inf], [np.inf, capacity], {item: 1})
+        if cheapest_better_bundle is not None:
+            O2[index] = prices @ cheapest_better_bundle
+    return O1, O2
+
+
 def score(placement: list[list[bool]], item_capacity: list[int]) -> float:
     """
     The function receives the course packages assigned to the students and a vector with
@@ -258,13 +410,20 @@ def score(placement: list[list[bool]], item_capacity: list[int]) -> float:
 
     logger.debug('score function')
 
-    ans = 0
-    placement_sum = np.sum(placement, axis=0)
-    for index, size in enumerate(placement_sum):
-        if item_capacity[index] < size:
-            ans += (size - item_capacity[index]) ** 2
+    return round(math.sqrt(squared_score(placement, item_capacity)), 3)
 
-    return round(math.sqrt(ans), 3)
+
+def squared_score(placement: list[list[bool]], item_capacity: list[int]) -> int:
+    """
+    The square of the score, without the square root and the rounding.
+    It is an exact integer, and it orders placements just like score does, so it is used for comparisons.
+
+    >>> squared_score([[0, 1, 1, 0],[0, 1, 1, 0], [0, 1, 1, 0]],[1,1,1,1])
+    8
+    """
+    excess_demand = np.sum(placement, axis=0) - np.asarray(item_capacity)
+    over_demand = np.clip(excess_demand, 0, None)   # only over-demanded courses count
+    return int(np.dot(over_demand, over_demand))
 
 
 def max_utility(utility: list[float], budget: float, prices: list[float], capacity_of_agent: int,
@@ -281,6 +440,8 @@ def max_utility(utility: list[float], budget: float, prices: list[float], capaci
     Example 1: best courses
     >>> max_utility([60,30,6,4],1.1,[1.1,0.9,0.1,0.0], 2)
     [1, 0, 0, 1]
+    >>> max_utility([60,30,6,4],2.0,[1.1,0.9,0.1,0.0], 2)
+    [1, 1, 0, 0]
 
     Example 2: not enough budget
     >>> max_utility([99, 1], 1.0, [1.2, 1.0], 1)
@@ -291,43 +452,87 @@ def max_utility(utility: list[float], budget: float, prices: list[float], capaci
     [0, 1, 0, 0, 0, 1]
     """
 
-    size = len(utility)
-    # Create binary variables
-    x = cp.Variable(shape=(size, 1), boolean=True)
-    # Define the objective function
-    objective = cp.Maximize(np.array(utility) @ x)
-    # Add constraints
-    constraints = [
-        sum([prices[item] * x[item] for item in range(len(prices))]) <= budget,
-        sum(x) <= capacity_of_agent
-    ]
-    # Form and solve the problem
-    prob = cp.Problem(objective, constraints)
-    prob.solve()
-    return x.value.ravel().astype(int).tolist()
+    utility = np.asarray(utility, dtype=float)
+    prices = np.asarray(prices, dtype=float)
+
+    # Only the items that the student might afford can be in the answer:
+    items = possibly_affordable_items(budget, prices)
+
+    # If the most valuable bundle of these items is unique and affordable, it is the answer - no need to look at other bundles.
+    # When the budget is tight, most of the valuable items are left out above, so this often succeeds:
+    ranked_items = items[np.argsort(-utility[items], kind="stable")]
+    top_size = min(capacity_of_agent, len(items))
+    top_items = ranked_items[:top_size]
+    if top_size > 0 and utility[top_items[-1]] > 0 \
+            and (top_size == len(items) or utility[top_items[-1]] > utility[ranked_items[top_size]]) \
+            and prices[top_items].sum() <= budget + PRICE_TOLERANCE:
+        placement = np.zeros(len(utility), dtype=np.int8)
+        placement[top_items] = 1
+        return placement.tolist()
+
+    placement = np.zeros(len(utility), dtype=np.int8)
+    if number_of_bundles(len(items), capacity_of_agent) > MAX_BUNDLES:
+        # Too many bundles to enumerate - solve an integer program:
+        bundle = solve_bundle_program(-utility[items], np.vstack([prices[items], np.ones(len(items))]),
+                                      [-np.inf, -np.inf], [budget + PRICE_TOLERANCE, capacity_of_agent])
+        if bundle is not None:
+            placement[items] = bundle
+        return placement.tolist()
+
+    # Otherwise, evaluate at once all bundles of these items:
+    bundles = bundle_matrix(len(items), capacity_of_agent)
+    values = bundle_values(tuple(utility[items].tolist()), capacity_of_agent)
+    bundle_prices = bundles @ prices[items]
+    affordable_values = np.where(bundle_prices <= budget + PRICE_TOLERANCE, values, -np.inf)
+    best_bundles = np.flatnonzero(affordable_values == affordable_values.max())
+    best_bundle_prices = bundle_prices[best_bundles]
+    # Among the best bundles, take the first of the cheapest (prices equal up to rounding are considered equal):
+    best_bundle = best_bundles[np.argmax(best_bundle_prices <= best_bundle_prices.min() + PRICE_TOLERANCE)]
+    placement[items] = bundles[best_bundle]
+    return placement.tolist()
+
+
+def possibly_affordable_items(budget: float, prices: np.ndarray) -> np.ndarray:
+    """
+    Return the indices of the items that may belong to a bundle the student can afford,
+    under at least one of the given price vectors (a single vector, or one vector per column).
+    A bundle with item i costs at least max(price[i],0) plus all the negative prices,
+    so if this bound exceeds the budget, no affordable bundle contains item i, and it can be left out of the search.
+    Leaving items out keeps the relative order of the remaining bundles in bundle_matrix, so the tie-breaking does not change.
+
+    >>> possibly_affordable_items(1.0, np.array([1.1, 0.9, 0.1, 0.0])).tolist()
+    [1, 2, 3]
+    >>> possibly_affordable_items(1.0, np.array([1.1, 0.9, 0.1, -0.2])).tolist()
+    [0, 1, 2, 3]
+    >>> possibly_affordable_items(1.0, np.array([[1.1, 0.5], [1.2, 1.3]])).tolist()
+    [0]
+    """
+    price_matrix = prices.reshape(len(prices), -1)
+    lower_bounds = np.maximum(price_matrix, 0) + np.minimum(price_matrix, 0).sum(axis=0)
+    return np.flatnonzero((lower_bounds <= budget + PRICE_TOLERANCE).any(axis=1))
 
 
-def max_utilities(utilities: ValuationMatrix, budgets: list[float], prices: list[float], agent_capacity: list[int],
+def max_utilities(utilities: np.ndarray, budgets: list[float], prices: list[float], agent_capacity: list[int],
                   effect_variables: list[dict[set, int]] = None, constraint: list[dict[set, int]] = None) \
         -> list[list[bool]]:
 
     """
-    The function receives a ValuationMatrix containing utilities of several students,
+    The function receives a matrix containing the utilities of several students,
     and calculates with the help of the max_utility function for each of the students
     the most affordable course package for him.
     Finally the function returns a matrix containing all the placements for all the students.
 
     Example 1:
-    >>> max_utilities(ValuationMatrix([[60,30,6,4],[62,32,4,2]]),[1.1,1.0],[1.1,0.9,0.1,0.0], [2,2])
+    >>> max_utilities(np.array([[60,30,6,4],[62,32,4,2]]),[1.1,1.0],[1.1,0.9,0.1,0.0], [2,2])
     [[1, 0, 0, 1], [0, 1, 1, 0]]
 
     Example 2:
-    >>> max_utilities(ValuationMatrix([[30, 70], [55, 45], [80, 20]]), [1.0, 1.1, 1.2], [1.2, 1.0], [1,1,1])
+    >>> max_utilities(np.array([[30, 70], [55, 45], [80, 20]]), [1.0, 1.1, 1.2], [1.2, 1.0], [1,1,1])
     [[0, 1], [0, 1], [1, 0]]
 
     Example 3:
     (after tabu search the output will be: [[1, 1, 0, 0, 0, 0], [0, 0, 1, 1, 0, 0], [0, 0, 0, 0, 1, 1]] )
-    >>> max_utilities(ValuationMatrix([[36, 35, 13, 10, 4, 2], [1, 3, 43, 37, 7, 9], [5, 13, 12, 17, 25, 28]]), [1.3, 1.1, 1.5], [0.9, 0.3, 0.9, 1.1, 1.0, 0.2], [2,2,2])
+    >>> max_utilities(np.array([[36, 35, 13, 10, 4, 2], [1, 3, 43, 37, 7, 9], [5, 13, 12, 17, 25, 28]]), [1.3, 1.1, 1.5], [0.9, 0.3, 0.9, 1.1, 1.0, 0.2], [2,2,2])
     [[1, 1, 0, 0, 0, 0], [0, 0, 1, 0, 0, 1], [0, 0, 0, 0, 1, 1]]
 
     """
@@ -340,13 +545,65 @@ def max_utilities(utilities: ValuationMatrix, budgets: list[float], prices: list
     # print("budgets: ", budgets)
     # print("prices: ", prices)
     # print("agent_capacity: ", agent_capacity)
-    for agent in utilities.agents():
+    for agent in range(len(utilities)):
         placement: list[bool] = max_utility(utilities[agent], budgets[agent], prices, agent_capacity[agent])
         placements.append(placement)
 
     return placements
 
 
+def max_utilities_for_prices(utilities: np.ndarray, budgets: list[float], price_vectors: list[list[float]], agent_capacity: list[int],
+                             max_workers: int = 1, bundle_values_cache: dict = None) \
+        -> np.ndarray:
+    """
+    Compute the result of max_utilities for several price vectors at once.
+    For each student, all bundles are priced under all price vectors with a single matrix product.
+    The students are independent, so with max_workers > 1 they are handled by a pool of threads
+    (numpy releases the GIL during the matrix operations).
+    bundle_values_cache is passed to bundle_values.
+
+    :return an int8 array of shape (number of price vectors, number of students, number of courses).
+
+    >>> max_utilities_for_prices(np.array([[60,30,6,4],[62,32,4,2]]),[1.1,1.0],[[1.1,0.9,0.1,0.0],[0.5,0.5,0.5,0.5]], [2,2]).tolist()
+    [[[1, 0, 0, 1], [0, 1, 1, 0]], [[1, 1, 0, 0], [1, 1, 0, 0]]]
+    >>> max_utilities_for_prices(np.array([[60,30,6,4],[62,32,4,2]]),[1.1,1.0],[[1.1,0.9,0.1,0.0],[0.5,0.5,0.5,0.5]], [2,2], max_workers=2).tolist()
+    [[[1, 0, 0, 1], [0, 1, 1, 0]], [[1, 1, 0, 0], [1, 1, 0, 0]]]
+    """
+    price_matrix = np.array(price_vectors, dtype=float).T     # column p is the p-th price vector
+    num_of_courses, num_of_price_vectors = price_matrix.shape
+    placements = np.zeros((num_of_price_vectors, len(budgets), num_of_courses), dtype=np.int8)
+    # The bundle prices do not depend on the student, so they are computed once for all students with the same capacity and candidate items:
+    bundle_prices_of_group = {}
+
+    def fill_placements(agent):
+        items = possibly_affordable_items(budgets[agent], price_matrix)
+        if number_of_bundles(len(items), agent_capacity[agent]) > MAX_BUNDLES:
+            # Too many bundles to enumerate - solve an integer program for each price vector:
+            for index, prices in enumerate(price_vectors):
+                placements[index, agent, :] = max_utility(utilities[agent], budgets[agent], prices, agent_capacity[agent])
+            return
+        bundles = bundle_matrix(len(items), agent_capacity[agent])
+        values = bundle_values(tuple(np.asarray(utilities[agent], dtype=float)[items].tolist()), agent_capacity[agent], bundle_values_cache)
+        group = (agent_capacity[agent], items.tobytes())
+        if group not in bundle_prices_of_group:
+            bundle_prices_of_group[group] = bundles @ price_matrix[items]     # one column per price vector
+        bundle_prices = bundle_prices_of_group[group]
+        affordable_values = np.where(bundle_prices <= budgets[agent] + PRICE_TOLERANCE, values[:,np.newaxis], -np.inf)
+        is_best = affordable_values == affordable_values.max(axis=0)
+        best_bundle_prices = np.where(is_best, bundle_prices, np.inf)
+        # Among the best bundles, take the first of the cheapest, exactly as max_utility does:
+        best_bundles = np.argmax(best_bundle_prices <= best_bundle_prices.min(axis=0) + PRICE_TOLERANCE, axis=0)
+        placements[:, agent, items] = bundles[best_bundles]
+
+    if max_workers > 1:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            list(executor.map(fill_placements, range(len(utilities))))   # list() re-raises any exception from a worker
+    else:
+        for agent in range(len(utilities)):
+            fill_placements(agent)
+    return placements
+
+
 class Course_Bundle:
     """
     Structure for a bundle of courses.
@@ -354,8 +611,8 @@ class Course_Bundle:
     which contains a priority queue, which needs to implement for
     the queue a comparison function between price vectors of packages.
 
-    >>> course_bundle1 = Course_Bundle(ValuationMatrix([[60,30,6,4],[62,32,4,2]]),[1.1,1.0],[1.1,0.9,0.1,0.0],[1,1,1,1], [2,2])
-    >>> course_bundle2 = Course_Bundle(ValuationMatrix([[36, 35, 13, 10, 4, 2], [1, 3, 43, 37, 7, 9], [5, 13, 12, 17, 25, 28]]), [1.3, 1.1, 1.5], [0.9, 0.3, 0.9, 1.1, 1.0, 0.2], [1,1,1,1,1,1], [2,2,2])
+    >>> course_bundle1 = Course_Bundle(np.array([[60,30,6,4],[62,32,4,2]]),[1.1,1.0],[1.1,0.9,0.1,0.0],[1,1,1,1], [2,2])
+    >>> course_bundle2 = Course_Bundle(np.array([[36, 35, 13, 10, 4, 2], [1, 3, 43, 37, 7, 9], [5, 13, 12, 17, 25, 28]]), [1.3, 1.1, 1.5], [0.9, 0.3, 0.9, 1.1, 1.0, 0.2], [1,1,1,1,1,1], [2,2,2])
 
     >>> course_bundle1.score()
     0.0
@@ -370,23 +627,30 @@ class Course_Bundle:
 
     """
 
-    def __init__(self, utilities: ValuationMatrix, budgets: list[float], prices: list[float], 
-                 item_capacity: list[int], agent_capacity: list[int]):
+    def __init__(self, utilities: np.ndarray, budgets: list[float], prices: list[float], 
+                 item_capacity: list[int], agent_capacity: list[int], placement: list[list[bool]] = None):
+        """
+        :param placement: the placement induced by the prices, if it was already computed (e.g. by max_utilities_for_prices).
+        """
         self.utilities = utilities
         self.budgets = budgets
         self.prices = prices
         self.item_capacity = item_capacity
         self.agent_capacity = agent_capacity
-        self.placement = max_utilities(self.utilities, self.budgets, self.prices, self.agent_capacity)
+        if placement is None:
+            placement = max_utilities(self.utilities, self.budgets, self.prices, self.agent_capacity)
+        self.placement = np.asarray(placement, dtype=np.int8)   # students x courses occupancy matrix
+        self.squared_score = squared_score(self.placement, self.item_capacity)   # computed once - the priority queue compares it many times
 
     def score(self):
-        return score(self.placement, self.item_capacity)
+        return round(math.sqrt(self.squared_score), 3)
 
-    def neighbors(self):
-        return neighbors(self.utilities, self.budgets, self.prices, self.item_capacity, self.agent_capacity)
+    def neighbors(self, bundle_values_cache: dict = None):
+        return neighbors(self.utilities, self.budgets, self.prices, self.item_capacity, self.agent_capacity,
+                         placement=self.placement, bundle_values_cache=bundle_values_cache)
 
     def __lt__(self, other):
-        return self.score() < other.score()
+        return self.squared_score < other.squared_score
 
     def __eq__(self, other):
         return np.array_equal(np.array(self.prices), np.array(other.prices))
@@ -399,8 +663,13 @@ if __name__ == '__main__':
     doctest.run_docstring_examples(course_allocation, globals())                                       # glp_add_cols: ncs = 0; invalid number of columns. Error detected in file ..\src\api\prob1.c at line 362
     doctest.run_docstring_examples(neighbors, globals())
     doctest.run_docstring_examples(score, globals())
+    doctest.run_docstring_examples(bundle_masks, globals())
+    doctest.run_docstring_examples(bundle_values, globals())
+    doctest.run_docstring_examples(solve_bundle_program, globals())
+    doctest.run_docstring_examples(squared_score, globals())
     doctest.run_docstring_examples(max_utility, globals())
     doctest.run_docstring_examples(max_utilities, globals())
+    doctest.run_docstring_examples(possibly_affordable_items, globals())
     doctest.run_docstring_examples(Course_Bundle, globals())
 
     from fairpyx.adaptors import divide_random_instance
@@ -18,12 +18,12 @@ between courses for students given a list of preferences for each student.
 import numpy
 
 import fairpyx
-from fairpyx import ValuationMatrix
+from fairpyx.zalternatives import othman_sandholm_budish
 
 import logging
 
-fairpyx.othman_sandholm_budish.logger.addHandler(logging.StreamHandler())
-fairpyx.othman_sandholm_budish.logger.setLevel(logging.INFO)
+othman_sandholm_budish.logger.addHandler(logging.StreamHandler())
+othman_sandholm_budish.logger.setLevel(logging.INFO)
 
 # The preference rating of the courses for each of the students:
 utilities = numpy.array([[60,30,6,4],[6,2,42,26]])
@@ -35,4 +35,4 @@ item_capacities = [2, 3, 1, 2]
 num_of_courses = 2
 
 # The Placement of students in the courses according to the algorithm:
-print(fairpyx.divide(fairpyx.othman_sandholm_budish, valuations=utilities, item_capacities=item_capacities, agent_capacities=num_of_courses))
+print(fairpyx.divide(othman_sandholm_budish.general_course_allocation, valuations=utilities, item_capacities=item_capacities, agent_capacities=num_of_courses))
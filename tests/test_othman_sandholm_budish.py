@@ -0,0 +1,109 @@
+"""
+Test the A-CEEI course allocation of Othman, Sandholm and Budish (2010).
+
+The module lives in fairpyx/zalternatives, which is not collected by pytest, so its doctests are run from here.
+
+Since:  2026-10
+"""
+
+import pytest
+
+import doctest
+import numpy as np
+from itertools import combinations
+from fairpyx.zalternatives import othman_sandholm_budish as osb
+
+NUM_OF_RANDOM_INSTANCES=200
+
+
+def best_affordable_value(utility, budget, prices, capacity):
+    """ The value of the best affordable bundle, found by brute force. """
+    return max(
+        sum(utility[item] for item in bundle)
+        for size in range(min(capacity, len(utility))+1)
+        for bundle in combinations(range(len(utility)), size)
+        if sum(prices[item] for item in bundle) <= budget + osb.PRICE_TOLERANCE
+    )
+
+
+def test_doctests():
+    (failures, tests) = doctest.testmod(osb, optionflags=doctest.ELLIPSIS)
+    assert tests > 0
+    assert failures == 0
+
+
+def test_bundle_matrix_lists_all_bundles_in_order():
+    for num_of_items in [0, 1, 5, 8, 9, 17, 64, 65]:
+        for capacity in range(4):
+            bundles = [bundle for size in range(min(capacity, num_of_items)+1) for bundle in combinations(range(num_of_items), size)]
+            matrix = osb.bundle_matrix(num_of_items, capacity)
+            assert matrix.dtype == np.int8
+            assert [tuple(np.flatnonzero(row)) for row in matrix] == bundles, f"{num_of_items} items, capacity {capacity}"
+
+
+def test_max_utility_is_optimal():
+    rng = np.random.default_rng(0)
+    for i in range(NUM_OF_RANDOM_INSTANCES):
+        num_of_items = rng.integers(1, 8)
+        utility = rng.integers(0, 10, num_of_items).tolist()
+        prices = rng.uniform(-0.3, 1.5, num_of_items).round(1).tolist()
+        budget = round(rng.uniform(0, 2), 1)
+        capacity = int(rng.integers(0, 5))
+        placement = osb.max_utility(utility, budget, prices, capacity)
+        assert sum(placement) <= capacity, f"Instance {i}"
+        assert np.dot(placement, prices) <= budget + osb.PRICE_TOLERANCE, f"Instance {i}"
+        assert np.dot(placement, utility) == best_affordable_value(utility, budget, prices, capacity), f"Instance {i}"
+
+
+def test_integer_program_fallback(monkeypatch):
+    """ With MAX_BUNDLES=0, the bundles are never enumerated, and the integer programs must find the same optima. """
+    rng = np.random.default_rng(3)
+    instances = []
+    for i in range(NUM_OF_RANDOM_INSTANCES // 4):
+        num_of_agents, num_of_items = rng.integers(1, 6), rng.integers(1, 7)
+        utilities = rng.integers(0, 10, (num_of_agents, num_of_items))
+        budgets = rng.uniform(0.5, 2, num_of_agents).round(1).tolist()
+        prices = rng.uniform(0, 1.5, num_of_items).round(1).tolist()
+        item_capacity = rng.integers(0, 3, num_of_items).tolist()
+        agent_capacity = rng.integers(0, 4, num_of_agents).tolist()
+        instances.append((utilities, budgets, prices, item_capacity, agent_capacity))
+    placements = [osb.max_utilities(*instance[:3], instance[4]) for instance in instances]
+    enumerated_neighbors = [osb.neighbors(*instance, placement=placement) for instance, placement in zip(instances, placements)]
+    monkeypatch.setattr(osb, "MAX_BUNDLES", 0)
+    for i, (utilities, budgets, prices, item_capacity, agent_capacity) in enumerate(instances):
+        for agent in range(len(utilities)):
+            placement = osb.max_utility(utilities[agent], budgets[agent], prices, agent_capacity[agent])
+            assert sum(placement) <= agent_capacity[agent], f"Instance {i}"
+            assert np.dot(placement, utilities[agent]) == best_affordable_value(utilities[agent], budgets[agent], prices, agent_capacity[agent]), f"Instance {i}"
+        assert osb.neighbors(utilities, budgets, prices, item_capacity, agent_capacity, placement=placements[i]) == enumerated_neighbors[i], f"Instance {i}"
+
+
+def test_max_utilities_for_prices_matches_max_utilities():
+    rng = np.random.default_rng(1)
+    for i in range(NUM_OF_RANDOM_INSTANCES):
+        num_of_agents, num_of_items = rng.integers(1, 6), rng.integers(1, 7)
+        utilities = rng.integers(0, 10, (num_of_agents, num_of_items))
+        budgets = rng.uniform(0.5, 2, num_of_agents).round(1).tolist()
+        agent_capacity = rng.integers(0, 4, num_of_agents).tolist()
+        price_vectors = rng.uniform(-0.3, 1.5, (3, num_of_items)).round(1).tolist()
+        placements = osb.max_utilities_for_prices(utilities, budgets, price_vectors, agent_capacity)
+        for prices, placement in zip(price_vectors, placements):
+            assert placement.tolist() == osb.max_utilities(utilities, budgets, prices, agent_capacity), f"Instance {i}"
+
+
+def test_course_allocation_respects_agent_capacities():
+    rng = np.random.default_rng(2)
+    for i in range(NUM_OF_RANDOM_INSTANCES // 10):
+        num_of_agents, num_of_items = rng.integers(2, 10), rng.integers(2, 7)
+        utilities = rng.integers(1, 60, (num_of_agents, num_of_items))
+        budgets = rng.uniform(1, 2, num_of_agents).round(2).tolist()
+        prices = rng.uniform(0, 1, num_of_items).round(2).tolist()
+        item_capacity = rng.integers(1, 4, num_of_items).tolist()
+        agent_capacity = rng.integers(1, 4, num_of_agents).tolist()
+        allocation = osb.course_allocation(utilities, budgets, prices, item_capacity, agent_capacity)
+        assert np.shape(allocation) == (num_of_agents, num_of_items), f"Instance {i}"
+        assert all(sum(bundle) <= capacity for bundle, capacity in zip(allocation, agent_capacity)), f"Instance {i}"
+
+
+if __name__ == "__main__":
+     pytest.main(["-v",__file__])